@@ -1,5 +1,10 @@
 from argparse import ArgumentParser, ArgumentTypeError
-from shuffler.shuffler import Shuffler
+import logging
+import os
+from shuffler.shuffler import INSTALLED_BACKENDS, Shuffler
+
+
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
 
 
 class MinMaxError(ArgumentTypeError):
@@ -42,8 +47,12 @@ def create_parser():
     parser.add_argument('--vertical', '-v', type=min_max_int(1, 5), default=4, help='Number of vertical blocks.')
     parser.add_argument('--height', '-he', type=min_max_int(100, 400), default=280, help='Block height.')
     parser.add_argument('--width', '-w', type=min_max_int(100, 400), default=200, help='Block width.')
-    parser.add_argument('--bottom', '-b', type=min_max_int(0, 50), default=17, help='Number of pixels from the bottom to ignore.')
+    parser.add_argument('--bottom', '-b', type=min_max_int(0, 50), default=17, help='Deprecated, has no effect: pixels outside blocks area are always kept unchanged.')
     parser.add_argument('--save-location', '-sl', nargs='?', type=str, default='res', help='Save location path')
+    parser.add_argument('--backend', '-be', choices=INSTALLED_BACKENDS, default='pillow', help='Library used to open and save images.')
+    parser.add_argument('--workers', '-wk', type=min_max_int(1), default=os.cpu_count() or 1, help='Number of processes that reshuffle images.')
+    parser.add_argument('--png-compress-level', '-pcl', type=min_max_int(0, 9), default=1, help='Compression level of PNG images.')
+    parser.add_argument('--log-level', '-ll', choices=LOG_LEVELS, default='WARNING', help='Logging level.')
     return parser
 
 
@@ -66,7 +75,11 @@ def parse_arguments(parser):
     b_width = args.width
     bottom_pixels = args.bottom
     save_location = args.save_location
-    return (file_list, folder_path, join_enabled, save_location), (b_height, b_width, h_blocks, v_blocks, bottom_pixels)
+    backend = args.backend
+    workers = args.workers
+    png_compress_level = args.png_compress_level
+    log_level = args.log_level
+    return (file_list, folder_path, join_enabled, save_location, backend, workers, png_compress_level, log_level), (b_height, b_width, h_blocks, v_blocks, bottom_pixels)
 
 
 def main():
@@ -76,14 +89,19 @@ def main():
 
     parser = create_parser()
 
-    (file_list, folder_path, join_enabled, save_location), arg_settings = parse_arguments(parser)
+    (file_list, folder_path, join_enabled, save_location, backend, workers, png_compress_level, log_level), arg_settings = parse_arguments(parser)
+
+    logging.basicConfig(level=log_level)
 
     shuffler = Shuffler(
         files=file_list,
         folder=folder_path,
         settings=arg_settings,
         is_join_enabled=join_enabled,
-        save_location=save_location
+        save_location=save_location,
+        backend=backend,
+        workers=workers,
+        png_compress_level=png_compress_level
     )
 
     shuffler.process_images(save=True)
@@ -0,0 +1,55 @@
+from numba import get_num_threads, njit, prange, set_num_threads
+
+
+@njit(parallel=True, cache=True, boundscheck=False)
+def reshuffle_blocks(image, processed_image, b_height, b_width, h_blocks, v_blocks):
+    """
+    Moves block (i, j) of image to (j, i) of processed image.
+    Pixels outside blocks area are not touched.
+
+    params:
+        image (np.array): C-contiguous image of shape (height, width, channels).
+        processed_image (np.array): output image of the same shape and dtype.
+        b_height (int): block height.
+        b_width (int): block width.
+        h_blocks (int): number of horizontal blocks.
+        v_blocks (int): number of vertical blocks.
+    """
+
+    # rows of block are contiguous in image flattened to (height, width*channels),
+    # so every block row is copied as one slice. reads and writes are sequential, so there is
+    # nothing strided to tile for cache and power of two rows (e.g. --width 256 on RGBA) are no slower
+    row = b_width * image.shape[2]
+    flat_image = image.reshape(image.shape[0], -1)
+    flat_processed_image = processed_image.reshape(processed_image.shape[0], -1)
+    for i in prange(h_blocks):
+        for j in range(v_blocks):
+            for r in range(b_height):
+                flat_processed_image[j*b_height + r, i*row:i*row + row] = flat_image[i*b_height + r, j*row:j*row + row]
+
+
+@njit(parallel=True, cache=True, boundscheck=False)
+def swap_blocks(image, b_height, b_width, blocks):
+    """
+    Swaps block (i, j) with block (j, i) of image in place.
+
+    params:
+        image (np.array): writable C-contiguous image of shape (height, width, channels).
+        b_height (int): block height.
+        b_width (int): block width.
+        blocks (int): number of horizontal and vertical blocks.
+    """
+
+    # rows of both blocks are contiguous in image flattened to (height, width*channels),
+    # so they are swapped row by row in a loop the compiler vectorizes
+    row = b_width * image.shape[2]
+    flat_image = image.reshape(image.shape[0], -1)
+    for i in prange(blocks):
+        for j in range(i + 1, blocks):
+            for r in range(b_height):
+                block_row = flat_image[i*b_height + r, j*row:j*row + row]
+                mirrored_block_row = flat_image[j*b_height + r, i*row:i*row + row]
+                for k in range(row):
+                    value = block_row[k]
+                    block_row[k] = mirrored_block_row[k]
+                    mirrored_block_row[k] = value
@@ -0,0 +1,33 @@
+from pathlib import Path
+from unittest import TestCase, mock, skipIf
+import numpy as np
+import shuffler.shuffler as shuffler_module
+from shuffler.shuffler import Shuffler
+
+
+SAMPLE = Path(__file__).parent.parent.joinpath('data', '1.jpg')
+
+
+@skipIf(shuffler_module.reshuffle_blocks is None, 'numba is not installed')
+class KernelsTestCase(TestCase):
+    """
+    Checks that numba kernels reshuffle images the same way NumPy path does.
+    """
+
+    def test_kernels_match_numpy(self):
+        rng = np.random.default_rng(0)
+        for settings in [(280, 200, 4, 4, 17), (100, 120, 3, 5, 0)]:
+            shuffler = Shuffler(files=[SAMPLE], settings=settings)
+            for channels in [(), (3,)]:
+                for dtype in [np.uint8, np.uint16]:
+                    image = rng.integers(0, np.iinfo(dtype).max, (1300, 1100, *channels), dtype=dtype, endpoint=True)
+                    for in_place in [False, True]:
+                        with self.subTest(settings=settings, channels=channels, dtype=dtype, in_place=in_place):
+                            # reshuffle kernel is dispatched only with several numba threads
+                            with mock.patch.object(shuffler_module, 'get_num_threads', return_value=2):
+                                with_kernels = shuffler._reshuffle_image(image.copy(), in_place=in_place)
+                            with mock.patch.multiple(shuffler_module, reshuffle_blocks=None, swap_blocks=None):
+                                without_kernels = shuffler._reshuffle_image(image.copy(), in_place=in_place)
+
+                            self.assertEqual(with_kernels.dtype, dtype)
+                            np.testing.assert_array_equal(with_kernels, without_kernels)